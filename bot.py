@@ -1,7 +1,17 @@
 import os
 import json
 import math
+import time
+import asyncio
+import cProfile
+import functools
+import pstats
+import contextvars
+import traceback
+import multiprocessing as mp
+from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -9,21 +19,36 @@ from telegram.ext import (
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
+    ApplicationHandlerStop,
     filters,
 )
 
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 
 # ============ ENV (aceita maiúsculas e minúsculas) ============
 BOT_TOKEN = os.getenv("BOT_TOKEN") or os.getenv("bot_token")
 SHEET_ID = os.getenv("SHEET_ID") or os.getenv("sheet_id") or os.getenv("GSHEET_ID")
 GOOGLE_SA_JSON = os.getenv("GOOGLE_SA_JSON") or os.getenv("google_sa_json")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("webhook_url")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or os.getenv("webhook_secret")
+PORT = int(os.getenv("PORT") or 8443)
+
+# Processos worker (1 = tudo no mesmo processo) e validade da cache de leituras do Sheets
+WORKERS = int(os.getenv("WORKERS") or 1)
+CACHE_TTL_S = float(os.getenv("CACHE_TTL_S") or 30)
+
+# Perfis guardados pelo /profile e nº de linhas no resumo
+PROFILE_DIR = os.getenv("PROFILE_DIR") or "profiles"
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N") or 15)
 
 TAB_USERS = "Users"
 TAB_SHIFTS = "Shifts"
 TAB_FIELDS = "Fields"
+TAB_TEAMS = "Teams"
 
 # Estados para o fluxo do ON (GPS)
 STATE_PICK_TEAM = "pick_team"
@@ -32,16 +57,355 @@ STATE_WAIT_WORKERS = "wait_workers"
 STATE_WAIT_LOCATION_ON = "wait_location_on"
 STATE_WAIT_LOCATION_OFF = "wait_location_off"
 
-# Listas simples para Equipas (podes depois ler do sheet se quiseres)
+# Equipas por defeito, usadas se a farm não tiver aba Teams
 TEAMS = ["Equipa A", "Equipa B", "Equipa C"]
 
+# Orçamento de leituras do Sheets por farm (pedidos/minuto, repartido pelos workers)
+FARM_QUOTA_RPM = float(os.getenv("FARM_QUOTA_RPM") or 60)
+
+
+def _load_farms() -> dict:
+    """FARMS='{"farm_a": "<sheet_id>", "farm_b": {"sheet_id": "...", "quota_rpm": 120}}'.
+
+    Sem FARMS, o SHEET_ID antigo passa a ser a farm "default".
+    """
+    raw = os.getenv("FARMS") or os.getenv("farms")
+    if not raw:
+        return {"default": {"sheet_id": SHEET_ID, "quota_rpm": FARM_QUOTA_RPM}} if SHEET_ID else {}
+
+    farms = {}
+    for farm_id, cfg in json.loads(raw).items():
+        if isinstance(cfg, str):
+            cfg = {"sheet_id": cfg}
+        farms[str(farm_id)] = {
+            "sheet_id": cfg["sheet_id"],
+            "quota_rpm": float(cfg.get("quota_rpm") or FARM_QUOTA_RPM),
+        }
+    return farms
+
+
+FARMS = _load_farms()
+DEFAULT_FARM = next(iter(FARMS), "default")
+
+# Farm da update em curso (definida por _bind_farm antes dos handlers)
+_FARM = contextvars.ContextVar("farm", default=DEFAULT_FARM)
+
+# HH: pausa por defeito (min), arredondamento da duração (min, 0 = sem) e tamanho dos blocos do recálculo
+HH_BREAK_MINUTES = int(os.getenv("HH_BREAK_MINUTES") or 0)
+HH_ROUND_MINUTES = int(os.getenv("HH_ROUND_MINUTES") or 0)
+HH_CHUNK_ROWS = int(os.getenv("HH_CHUNK_ROWS") or 2000)
+HH_BATCH_CELLS = int(os.getenv("HH_BATCH_CELLS") or 500)
+
+
+# ============ Cache / broker ============
+class LocalBroker:
+    """Cache de leituras do Sheets, local a cada processo.
+
+    Os valores nunca saem do processo; entre processos só circula a versão de
+    cada aba em `versions` (um dict no modo simples, o dict de um
+    `multiprocessing.Manager` no modo multi-processo). Invalidar muda a versão:
+    as entradas antigas deixam de ser válidas mas continuam disponíveis como
+    cópia antiga com `get(key, stale=True)`. Para trocar de backend (ex: Redis)
+    basta um objeto com get/version/set/invalidate.
+    """
+
+    def __init__(self, versions=None, ttl_s: float = CACHE_TTL_S):
+        self._cache = {}
+        self._versions = versions if versions is not None else {}
+        self._ttl_s = ttl_s
+
+    @staticmethod
+    def _scope(key: str) -> str:
+        # "farm:Shifts!A:Z" → "farm:Shifts!" (chaves sem aba não têm versão)
+        return key.split("!", 1)[0] + "!" if "!" in key else ""
+
+    def version(self, key: str):
+        scope = self._scope(key)
+        return self._versions.get(scope, 0) if scope else 0
+
+    def get(self, key: str, stale: bool = False):
+        hit = self._cache.get(key)
+        if hit is None:
+            return None
+        ts, version, value = hit
+        if not stale and (time.time() - ts > self._ttl_s or version != self.version(key)):
+            return None
+        return value
+
+    def set(self, key: str, value, version=None):
+        # `version` lida antes da leitura ao Sheets: uma escrita entretanto invalida esta entrada
+        self._cache[key] = (time.time(), self.version(key) if version is None else version, value)
+
+    def invalidate(self, prefix: str):
+        # Versão única em vez de contador: duas invalidações em simultâneo nunca se anulam
+        self._versions[prefix] = f"{os.getpid()}:{time.monotonic_ns()}"
+
+
+_BROKER = LocalBroker()
+
+
+def _set_broker(broker):
+    global _BROKER
+    _BROKER = broker
+
+
+def _farm_key(range_a1: str) -> str:
+    # Chaves da cache separadas por farm: cada farm só vê (e invalida) os seus dados
+    return f"{_FARM.get()}:{range_a1}"
+
+
+def _invalidate_tab(range_a1: str):
+    # Qualquer escrita numa aba invalida todas as leituras em cache dessa aba
+    _BROKER.invalidate(_farm_key(range_a1.split("!", 1)[0] + "!"))
+
+
+# ============ Farms (multi-tenant) ============
+class _QuotaBudget:
+    """Token bucket de leituras do Sheets de uma farm, neste processo.
+
+    Limita quantas leituras a farm faz, não quanto tempo cada uma demora: as
+    chamadas ao Sheets e a descodificação correm no event loop partilhado por
+    todas as farms, por isso um fetch grande de uma farm atrasa as outras.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(per_minute / 4.0, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_s(self) -> float:
+        # Segundos até haver um pedido disponível (0 = pode avançar já)
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+
+_QUOTAS: dict = {}
+
+
+class FarmQuotaExceeded(RuntimeError):
+    """Farm sem orçamento de leituras e sem cópia em cache; tentar de novo daqui a `retry_s`."""
+
+    def __init__(self, farm_id: str, retry_s: float):
+        super().__init__(f"Farm '{farm_id}' sem orçamento de leituras do Sheets ({retry_s:.0f} s)")
+        self.farm_id = farm_id
+        self.retry_s = retry_s
+
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def _farm_sheet_id() -> str:
+    farm = FARMS.get(_FARM.get())
+    if not farm or not farm["sheet_id"]:
+        raise RuntimeError(f"Farm '{_FARM.get()}' sem spreadsheet (FARMS/SHEET_ID)")
+    return farm["sheet_id"]
+
+
+def _farm_quota() -> _QuotaBudget:
+    farm_id = _FARM.get()
+    budget = _QUOTAS.get(farm_id)
+    if budget is None:
+        rpm = FARMS.get(farm_id, {}).get("quota_rpm", FARM_QUOTA_RPM)
+        budget = _QUOTAS[farm_id] = _QuotaBudget(rpm / max(WORKERS, 1))
+    return budget
+
+
+def _resolve_farm(telegram_id: int):
+    """Farm onde o utilizador está na aba Users (primeira que o tiver), ou None.
+
+    Uma farm em erro (spreadsheet lento, em baixo ou sem orçamento) é saltada;
+    se o utilizador não aparecer em mais nenhuma, o erro é levantado e nada
+    fica em cache, para não o dar como desconhecido por engano.
+    """
+    if len(FARMS) <= 1:
+        return next(iter(FARMS), None)
+
+    key = f"farm-of:{telegram_id}"
+    farm = _BROKER.get(key)
+    if farm is not None:
+        return farm or None
+
+    failed = None
+    for farm_id in FARMS:
+        token = _FARM.set(farm_id)
+        try:
+            if _find_user_row_by_telegram_id(telegram_id):
+                _BROKER.set(key, farm_id)
+                return farm_id
+        except Exception as e:
+            print(f"⚠️ Farm '{farm_id}' indisponível a procurar o utilizador {telegram_id}: {e!r}")
+            failed = e
+        finally:
+            _FARM.reset(token)
+
+    if failed is not None:
+        raise failed
+    _BROKER.set(key, "")
+    return None
+
+
+async def _bind_farm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Corre antes dos handlers (grupo -1): o resto da update usa a farm do utilizador.
+    # As updates correm em sequência na mesma task: primeiro repõe a farm por defeito,
+    # para nunca herdar a farm (e o spreadsheet) da update anterior.
+    _FARM.set(DEFAULT_FARM)
+    user = update.effective_user
+    try:
+        farm = _resolve_farm(user.id) if user else None
+    except Exception as e:
+        print(f"⚠️ Sem farm para o utilizador {user.id}: {e!r}")
+        if update.effective_message:
+            await update.effective_message.reply_text("⚠️ Não foi possível identificar a tua farm. Tenta daqui a pouco.")
+        raise ApplicationHandlerStop
+    _FARM.set(farm or DEFAULT_FARM)
+
+
+# ============ Profiler (admin) ============
+class _ProfileSession:
+    """Perfil cProfile acumulado das próximas `remaining` updates (de um handler ou de todos).
+
+    O cProfile e os tempos de parede/CPU são do processo inteiro: o que outras
+    tasks correrem durante os `await` do handler entra também na divisão CPU/I/O.
+    """
+
+    def __init__(self, chat_id: int, remaining: int, handler: str | None):
+        self.chat_id = chat_id
+        self.remaining = remaining
+        self.handler = handler
+        self.profiler = cProfile.Profile()
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.sheets_wall = 0.0
+        self.sheets_cpu = 0.0
+        self.active = False
+
+
+_PROFILE: _ProfileSession | None = None
+# Sessão do handler que está a ser perfilado agora (só aí o tempo do Sheets conta)
+_PROFILING: contextvars.ContextVar = contextvars.ContextVar("profiling", default=None)
+_PROFILED_HANDLERS: set = set()
+
+
+def _arm_profile(chat_id: int, count: int, handler: str | None):
+    global _PROFILE
+    if _PROFILE is not None and _PROFILE.active:
+        # Larga a sessão anterior antes que a nova ative um segundo cProfile
+        _PROFILE.profiler.disable()
+    _PROFILE = _ProfileSession(chat_id, count, handler) if count > 0 else None
+
+
+def _parse_profile_args(args: list):
+    """`/profile N [handler]` → (N, handler); `/profile off` → (0, None); inválido → None."""
+    if not args:
+        return None
+    if args[0].lower() == "off":
+        return 0, None
+    if not args[0].isdigit() or int(args[0]) <= 0:
+        return None
+    handler = args[1] if len(args) > 1 else None
+    if handler and handler not in _PROFILED_HANDLERS:
+        return None
+    return int(args[0]), handler
+
+
+def _execute(request):
+    # Fora de um handler perfilado é só request.execute(); dentro mede o tempo gasto no Sheets
+    session = _PROFILING.get()
+    if session is None:
+        return request.execute()
+    t0, c0 = time.perf_counter(), time.process_time()
+    try:
+        return request.execute()
+    finally:
+        session.sheets_wall += time.perf_counter() - t0
+        session.sheets_cpu += time.process_time() - c0
+
+
+def _profiled(handler):
+    name = handler.__name__
+    _PROFILED_HANDLERS.add(name)
+
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        session = _PROFILE
+        if session is None or (session.handler and session.handler != name):
+            return await handler(update, context)
+        # Só um cProfile ativo de cada vez (em 3.12 um segundo enable() dá ValueError):
+        # updates que chegam durante os await de outra já perfilada correm sem perfil
+        if session.active:
+            return await handler(update, context)
+
+        token = _PROFILING.set(session)
+        t0, c0 = time.perf_counter(), time.process_time()
+        session.active = True
+        session.profiler.enable()
+        try:
+            return await handler(update, context)
+        finally:
+            session.profiler.disable()
+            session.active = False
+            _PROFILING.reset(token)
+            session.wall += time.perf_counter() - t0
+            session.cpu += time.process_time() - c0
+            session.calls += 1
+            if session.calls >= session.remaining and session is _PROFILE:
+                await _finish_profile(context.bot, session)
+
+    return wrapper
+
+
+def _profile_summary(session: _ProfileSession, path: str) -> str:
+    sheets_io = max(session.sheets_wall - session.sheets_cpu, 0.0)
+    other_io = max(session.wall - session.cpu - sheets_io, 0.0)
+    lines = [
+        f"⏱️ Perfil: {session.calls} updates ({session.handler or 'todos os handlers'}, pid {os.getpid()})",
+        f"Total: {session.wall:.2f} s | CPU: {session.cpu:.2f} s",
+        f"I/O Sheets: {sheets_io:.2f} s | I/O Telegram/outro: {other_io:.2f} s",
+        f"Top {PROFILE_TOP_N} (tempo próprio / acumulado / chamadas):",
+    ]
+    stats = pstats.Stats(session.profiler).stats
+    top = sorted(stats.items(), key=lambda kv: kv[1][2], reverse=True)[:PROFILE_TOP_N]
+    for (filename, lineno, func), (_, ncalls, tottime, cumtime, _) in top:
+        lines.append(
+            f"{tottime * 1000:.0f} ms / {cumtime * 1000:.0f} ms / {ncalls}× "
+            f"{os.path.basename(filename)}:{lineno}({func})"
+        )
+    lines.append(f"💾 {path}")
+    return "\n".join(lines)[:4000]
+
+
+async def _finish_profile(bot, session: _ProfileSession):
+    global _PROFILE
+    _PROFILE = None
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(PROFILE_DIR, f"{stamp}_{session.handler or 'all'}_{os.getpid()}.prof")
+    session.profiler.dump_stats(path)
+
+    summary = _profile_summary(session, path)
+    print(summary)
+    await bot.send_message(session.chat_id, summary)
+
 
 # ============ Sheets helpers ============
 def _sheets_service():
     if not GOOGLE_SA_JSON:
         raise RuntimeError("GOOGLE_SA_JSON/google_sa_json não definido no Render")
-    if not SHEET_ID:
-        raise RuntimeError("SHEET_ID/sheet_id não definido no Render")
+    if not FARMS:
+        raise RuntimeError("SHEET_ID/sheet_id ou FARMS não definido no Render")
 
     info = json.loads(GOOGLE_SA_JSON)
     scopes = ["https://www.googleapis.com/auth/spreadsheets"]
@@ -49,69 +413,294 @@ def _sheets_service():
     return build("sheets", "v4", credentials=creds, cache_discovery=False)
 
 
-def _get_values(range_a1: str):
+def _read_budget(key: str | None):
+    """Aplica o orçamento da farm a uma leitura; sem orçamento devolve a cópia antiga se existir.
+
+    Nunca dorme no event loop (bloquearia as updates das outras farms): sem cópia
+    antiga levanta FarmQuotaExceeded. Só jobs em thread (ex: /recalc_hh) esperam.
+    """
+    budget = _farm_quota()
+    wait = budget.wait_s()
+    if wait:
+        stale = _BROKER.get(key, stale=True) if key else None
+        if stale is not None:
+            return stale
+        if _in_event_loop():
+            raise FarmQuotaExceeded(_FARM.get(), wait)
+        time.sleep(wait)
+    budget.consume()
+    return None
+
+
+def _fetch_values(range_a1: str):
     svc = _sheets_service()
-    resp = svc.spreadsheets().values().get(
-        spreadsheetId=SHEET_ID, range=range_a1
-    ).execute()
+    resp = _execute(svc.spreadsheets().values().get(
+        spreadsheetId=_farm_sheet_id(), range=range_a1
+    ))
     return resp.get("values", [])
 
 
+def _get_values(range_a1: str, cache: bool = True):
+    key = _farm_key(range_a1) if cache else None
+    if key:
+        cached = _BROKER.get(key)
+        if cached is not None:
+            return cached
+        version = _BROKER.version(key)
+
+    stale = _read_budget(key)
+    if stale is not None:
+        return stale
+
+    values = _fetch_values(range_a1)
+    if key:
+        _BROKER.set(key, values, version)
+    return values
+
+
 def _append_values(range_a1: str, values: list[list]):
     svc = _sheets_service()
-    svc.spreadsheets().values().append(
-        spreadsheetId=SHEET_ID,
+    _execute(svc.spreadsheets().values().append(
+        spreadsheetId=_farm_sheet_id(),
         range=range_a1,
         valueInputOption="USER_ENTERED",
         insertDataOption="INSERT_ROWS",
         body={"values": values},
-    ).execute()
+    ))
+    _invalidate_tab(range_a1)
 
 
 def _update_values(range_a1: str, values: list[list]):
     svc = _sheets_service()
-    svc.spreadsheets().values().update(
-        spreadsheetId=SHEET_ID,
+    _execute(svc.spreadsheets().values().update(
+        spreadsheetId=_farm_sheet_id(),
         range=range_a1,
         valueInputOption="USER_ENTERED",
         body={"values": values},
-    ).execute()
+    ))
+    _invalidate_tab(range_a1)
 
 
-# ============ Auth / roles ============
-def _find_user_row_by_telegram_id(telegram_id: int):
-    rows = _get_values(f"{TAB_USERS}!A:D")
-    if not rows or len(rows) < 2:
+def _batch_update_values(data: list[dict]):
+    svc = _sheets_service()
+    _execute(svc.spreadsheets().values().batchUpdate(
+        spreadsheetId=_farm_sheet_id(),
+        body={"valueInputOption": "USER_ENTERED", "data": data},
+    ))
+    for range_a1 in {d["range"].split("!", 1)[0] for d in data}:
+        _invalidate_tab(range_a1)
+
+
+def _col_letter(idx: int) -> str:
+    # 0 -> A, 25 -> Z, 26 -> AA
+    out = ""
+    n = idx + 1
+    while n:
+        n, rem = divmod(n - 1, 26)
+        out = chr(65 + rem) + out
+    return out
+
+
+# ============ Schema (linhas → registos) ============
+# Colunas de cada aba e posição por defeito se o cabeçalho não existir
+USER_COLUMNS = {"telegram_id": 0, "name": 1, "role": 2}
+FIELD_COLUMNS = {"field_id": 0, "field_name": 1, "lat": 2, "lon": 3, "radius_m": 4}
+SHIFT_COLUMNS = {
+    "shift_id": 0,            # A
+    "date": 1,                # B
+    "team": 2,                # C
+    "field": 3,               # D
+    "field_id": 4,            # E
+    "lead_telegram_id": 5,    # F
+    "start_time": 6,          # G
+    "end_time": 7,            # H
+    "workers_start": 8,       # I
+    "status": 9,              # J
+    "hh_total": 10,           # K
+    "break_min": None,        # opcional (pausa do turno em minutos)
+}
+
+_SCHEMAS: dict = {}
+
+
+@dataclass(slots=True)
+class UserRec:
+    sheet_row: int
+    telegram_id: str
+    name: str
+    role: str
+
+
+@dataclass(slots=True)
+class FieldRec:
+    field_id: str
+    field_name: str
+    lat: float | None
+    lon: float | None
+    radius_m: float | None
+
+
+@dataclass(slots=True)
+class ShiftRec:
+    sheet_row: int
+    shift_id: str
+    date: str
+    team: str
+    field: str
+    field_id: str
+    lead_telegram_id: str
+    start_time: str
+    end_time: str
+    workers: int | None
+    status: str
+    hh: float | None
+    break_min: int | None
+
+
+def _parse_int(value):
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_float(value):
+    try:
+        return float(str(value).strip().replace(",", "."))
+    except (TypeError, ValueError):
         return None
 
-    headers = rows[0]
-    data = rows[1:]
 
-    def idx(col, default):
-        return headers.index(col) if col in headers else default
+def _schema(tab: str, headers: list, columns: dict) -> dict:
+    # Mapa cabeçalho → coluna resolvido uma vez por versão do cabeçalho da aba (None = coluna opcional ausente)
+    key = (tab, tuple(headers))
+    cols = _SCHEMAS.get(key)
+    if cols is None:
+        cols = {name: headers.index(name) if name in headers else default for name, default in columns.items()}
+        _SCHEMAS[key] = cols
+    return cols
 
-    idx_id = idx("telegram_id", 0)
-    idx_name = idx("name", 1)
-    idx_role = idx("role", 2)
 
-    for sheet_row, r in enumerate(data, start=2):
-        if len(r) <= idx_id:
-            continue
-        if str(r[idx_id]).strip() == str(telegram_id):
-            name = r[idx_name] if len(r) > idx_name else ""
-            role = r[idx_role] if len(r) > idx_role else ""
-            return {"sheet_row": sheet_row, "name": name, "role": role}
+def _padded_rows(rows: list[list], width: int, start: int = 2):
+    # Completa linhas curtas (o Sheets corta células vazias no fim) para evitar guardas len()
+    for sheet_row, r in enumerate(rows, start=start):
+        if len(r) < width:
+            r = r + [""] * (width - len(r))
+        yield sheet_row, r
+
+
+def _decode_users(rows: list[list]) -> dict:
+    if not rows or len(rows) < 2:
+        return {}
+    c = _schema(TAB_USERS, rows[0], USER_COLUMNS)
+    i_id, i_name, i_role = c["telegram_id"], c["name"], c["role"]
+    out = {}
+    for sheet_row, r in _padded_rows(rows[1:], max(c.values()) + 1):
+        tid = str(r[i_id]).strip()
+        if tid and tid not in out:
+            out[tid] = UserRec(sheet_row, tid, str(r[i_name]).strip(), str(r[i_role]).strip().lower())
+    return out
+
+
+def _decode_fields(rows: list[list]) -> dict:
+    if not rows or len(rows) < 2:
+        return {}
+    c = _schema(TAB_FIELDS, rows[0], FIELD_COLUMNS)
+    i_id, i_name, i_lat, i_lon, i_rad = c["field_id"], c["field_name"], c["lat"], c["lon"], c["radius_m"]
+    out = {}
+    for _, r in _padded_rows(rows[1:], max(c.values()) + 1):
+        field_id = str(r[i_id]).strip()
+        if field_id and field_id not in out:
+            out[field_id] = FieldRec(
+                field_id, str(r[i_name]).strip(),
+                _parse_float(r[i_lat]), _parse_float(r[i_lon]), _parse_float(r[i_rad]),
+            )
+    return out
+
+
+def _decode_shifts(rows: list[list]) -> list:
+    if not rows or len(rows) < 2:
+        return []
+    c = _schema(TAB_SHIFTS, rows[0], SHIFT_COLUMNS)
+    i = [c[name] for name in SHIFT_COLUMNS]
+    (i_sid, i_date, i_team, i_field, i_fid, i_lead,
+     i_start, i_end, i_workers, i_status, i_hh, i_break) = i
+    width = max(x for x in i if x is not None) + 1
+    return [
+        ShiftRec(
+            sheet_row, r[i_sid], str(r[i_date]).strip(), r[i_team], r[i_field], str(r[i_fid]).strip(),
+            str(r[i_lead]).strip(), str(r[i_start]).strip(), str(r[i_end]).strip(),
+            _parse_int(r[i_workers]), str(r[i_status]).strip().upper(), _parse_float(r[i_hh]),
+            _parse_int(r[i_break]) if i_break is not None else None,
+        )
+        for sheet_row, r in _padded_rows(rows[1:], width)
+    ]
+
+
+def _load_records(range_a1: str, decode, stale_ok: bool = True):
+    # Guarda os registos já descodificados (não as linhas em bruto) na cache do processo.
+    # stale_ok=False: sem orçamento nunca devolve a cópia antiga (pode ser de antes de uma escrita nossa)
+    key = _farm_key(f"{range_a1}#records")
+    records = _BROKER.get(key)
+    if records is None:
+        records = _read_budget(key if stale_ok else None)
+    if records is None:
+        version = _BROKER.version(key)
+        records = decode(_fetch_values(range_a1))
+        _BROKER.set(key, records, version)
+    return records
+
+
+def _users():
+    return _load_records(f"{TAB_USERS}!A:D", _decode_users)
+
+
+def _fields():
+    return _load_records(f"{TAB_FIELDS}!A:E", _decode_fields)
+
+
+def _shifts():
+    # A:Z e não A:N: a coluna opcional break_min pode estar depois de N.
+    # Nunca cópia antiga: estas leituras decidem se um turno é aberto/fechado (evita OPEN duplicado)
+    return _load_records(f"{TAB_SHIFTS}!A:Z", _decode_shifts, stale_ok=False)
+
+
+def _decode_teams(rows: list[list]) -> list:
+    if not rows or len(rows) < 2:
+        return []
+    i = _schema(TAB_TEAMS, rows[0], {"team": 0})["team"]
+    teams = []
+    for _, r in _padded_rows(rows[1:], i + 1):
+        team = str(r[i]).strip()
+        if team and team not in teams:
+            teams.append(team)
+    return teams
+
+
+def _teams():
+    # Equipas da aba Teams da farm; sem aba (ou vazia) usa TEAMS
+    try:
+        # A:Z para o cabeçalho "team" poder estar em qualquer coluna
+        teams = _load_records(f"{TAB_TEAMS}!A:Z", _decode_teams)
+    except HttpError as e:
+        # Só "aba inexistente" fica em cache; auth, 429 ou rede propagam
+        if e.resp.status != 400 or "Unable to parse range" not in str(e):
+            raise
+        teams = []
+        _BROKER.set(_farm_key(f"{TAB_TEAMS}!A:Z#records"), teams)
+    return teams or TEAMS
 
-    return None
+
+# ============ Auth / roles ============
+def _find_user_row_by_telegram_id(telegram_id: int):
+    return _users().get(str(telegram_id))
 
 
 def _get_user_role_and_name(telegram_id: int):
     u = _find_user_row_by_telegram_id(telegram_id)
     if not u:
         return None, ""
-    role = (u["role"] or "").strip().lower()
-    name = (u["name"] or "").strip()
-    return role, name
+    return u.role, u.name
 
 
 def _can_manage_shifts(role: str) -> bool:
@@ -137,14 +726,35 @@ def _make_shift_id(date_str: str, team: str, field_id: str):
     return f"{date_str}_{t}_{f}"
 
 
-def _calc_hh_total(start_time: str, end_time: str, workers: int) -> float:
-    fmt = "%H:%M"
-    s = datetime.strptime(start_time, fmt)
-    e = datetime.strptime(end_time, fmt)
-    delta_hours = (e - s).total_seconds() / 3600.0
-    if delta_hours < 0:
-        delta_hours = 0
-    return round(delta_hours * workers, 2)
+@lru_cache(maxsize=4096)
+def _hhmm_to_min(value: str):
+    try:
+        t = datetime.strptime(str(value).strip(), "%H:%M")
+    except ValueError:
+        return None
+    return t.hour * 60 + t.minute
+
+
+def _shift_minutes(start_min: int, end_min: int, break_min: int = HH_BREAK_MINUTES) -> int:
+    # Módulo 24h: turnos que atravessam a meia-noite (22:00→06:00 = 8h)
+    minutes = (end_min - start_min) % 1440
+    minutes = max(minutes - break_min, 0)
+    if HH_ROUND_MINUTES > 0:
+        minutes = int(round(minutes / HH_ROUND_MINUTES)) * HH_ROUND_MINUTES
+    return minutes
+
+
+def _calc_hh_total(start_time: str, end_time: str, workers: int, break_min: int = HH_BREAK_MINUTES) -> float:
+    s = _hhmm_to_min(start_time)
+    e = _hhmm_to_min(end_time)
+    if s is None or e is None:
+        raise ValueError(f"Hora inválida: {start_time!r} / {end_time!r}")
+    return round(_shift_minutes(s, e, break_min) / 60.0 * workers, 2)
+
+
+def _shift_break(shift) -> int:
+    # Pausa da linha (coluna break_min) ou a pausa por defeito, igual ao /recalc_hh
+    return HH_BREAK_MINUTES if shift.break_min is None else shift.break_min
 
 
 # ============ GPS helpers ============
@@ -158,137 +768,140 @@ def _haversine_m(lat1, lon1, lat2, lon2):
 
 
 def _get_field_by_id(field_id: str):
-    rows = _get_values(f"{TAB_FIELDS}!A:E")
-    if not rows or len(rows) < 2:
+    field = _fields().get(str(field_id).strip())
+    if not field or field.lat is None or field.lon is None or field.radius_m is None:
         return None
+    return field
 
-    headers = rows[0]
-    data = rows[1:]
-
-    def idx(col, default):
-        return headers.index(col) if col in headers else default
-
-    i_id = idx("field_id", 0)
-    i_name = idx("field_name", 1)
-    i_lat = idx("lat", 2)
-    i_lon = idx("lon", 3)
-    i_rad = idx("radius_m", 4)
 
-    for r in data:
-        if len(r) <= max(i_id, i_name, i_lat, i_lon, i_rad):
-            continue
-        if str(r[i_id]).strip() == str(field_id).strip():
-            try:
-                return {
-                    "field_id": str(r[i_id]).strip(),
-                    "field_name": str(r[i_name]).strip(),
-                    "lat": float(str(r[i_lat]).replace(",", ".")),
-                    "lon": float(str(r[i_lon]).replace(",", ".")),
-                    "radius_m": float(str(r[i_rad]).replace(",", ".")),
-                }
-            except:
-                return None
-    return None
-
-
-def _is_inside_field(user_lat: float, user_lon: float, field: dict):
-    d = _haversine_m(user_lat, user_lon, field["lat"], field["lon"])
-    return d <= field["radius_m"], int(d)
+def _is_inside_field(user_lat: float, user_lon: float, field: FieldRec):
+    d = _haversine_m(user_lat, user_lon, field.lat, field.lon)
+    return d <= field.radius_m, int(d)
 
 
 # ============ Shift queries (Shifts A:N) ============
 def _find_open_shift_for_lead_today(lead_telegram_id: int):
-    rows = _get_values(f"{TAB_SHIFTS}!A:N")
-    if not rows or len(rows) < 2:
-        return None
-
-    headers = rows[0]
-    data = rows[1:]
-
-    def idx(col, default):
-        return headers.index(col) if col in headers else default
-
-    idx_shift_id = idx("shift_id", 0)        # A
-    idx_date = idx("date", 1)                # B
-    idx_lead = idx("lead_telegram_id", 5)    # F
-    idx_status = idx("status", 9)            # J
-
-    for sheet_row, r in enumerate(data, start=2):
-        lead = r[idx_lead] if len(r) > idx_lead else ""
-        status = (r[idx_status] if len(r) > idx_status else "").strip().upper()
-        date_str = r[idx_date] if len(r) > idx_date else ""
-        if str(lead).strip() == str(lead_telegram_id) and status == "OPEN" and date_str == _today_str():
-            shift_id = r[idx_shift_id] if len(r) > idx_shift_id else ""
-            return {"sheet_row": sheet_row, "shift_id": shift_id, "row": r, "headers": headers}
-
+    lead = str(lead_telegram_id)
+    today = _today_str()
+    for s in _shifts():
+        if s.lead_telegram_id == lead and s.status == "OPEN" and s.date == today:
+            return s
     return None
 
 
 def _list_shifts_today():
-    rows = _get_values(f"{TAB_SHIFTS}!A:N")
-    if not rows or len(rows) < 2:
-        return []
-
-    headers = rows[0]
-    data = rows[1:]
-
-    def idx(col, default):
-        return headers.index(col) if col in headers else default
-
-    idx_date = idx("date", 1)          # B
-    idx_team = idx("team", 2)          # C
-    idx_field = idx("field", 3)        # D
-    idx_start = idx("start_time", 6)   # G
-    idx_end = idx("end_time", 7)       # H
-    idx_workers = idx("workers_start", 8)  # I
-    idx_status = idx("status", 9)      # J
-    idx_hh = idx("hh_total", 10)       # K
-
-    out = []
-    for r in data:
-        date_str = r[idx_date] if len(r) > idx_date else ""
-        if date_str != _today_str():
+    today = _today_str()
+    return [s for s in _shifts() if s.date == today]
+
+
+# ============ HH bulk (recalcular histórico) ============
+def _recalc_hh_chunk(data: list[list], start_row: int, cols: dict):
+    """Recalcula HH de um bloco de linhas por colunas; devolve [(sheet_row, hh)] que mudaram."""
+    width = max(i for i in cols.values() if i is not None) + 1
+    rows = [r for _, r in _padded_rows(data, width)]
+
+    def column(i):
+        return [r[i] for r in rows]
+
+    # Colunas extraídas uma vez e convertidas em bloco (horas → minutos do dia)
+    starts = [_hhmm_to_min(v) for v in column(cols["start"])]
+    ends = [_hhmm_to_min(v) for v in column(cols["end"])]
+    workers = [_parse_int(v) for v in column(cols["workers"])]
+    stored = [_parse_float(v) for v in column(cols["hh"])]
+    if cols["break"] is not None:
+        breaks = [_parse_int(v) for v in column(cols["break"])]
+    else:
+        breaks = [None] * len(data)
+
+    changed = []
+    skipped = 0
+    for offset, (s, e, w, b, old) in enumerate(zip(starts, ends, workers, breaks, stored)):
+        if s is None or e is None or not w or w <= 0:
+            skipped += 1
             continue
-        out.append({
-            "team": r[idx_team] if len(r) > idx_team else "",
-            "field": r[idx_field] if len(r) > idx_field else "",
-            "start": r[idx_start] if len(r) > idx_start else "",
-            "end": r[idx_end] if len(r) > idx_end else "",
-            "workers": r[idx_workers] if len(r) > idx_workers else "",
-            "status": r[idx_status] if len(r) > idx_status else "",
-            "hh": r[idx_hh] if len(r) > idx_hh else "",
-        })
-    return out
+        minutes = _shift_minutes(s, e, HH_BREAK_MINUTES if b is None else b)
+        hh = round(minutes / 60.0 * w, 2)
+        if old is None or abs(old - hh) > 0.005:
+            changed.append((start_row + offset, hh))
+    return changed, skipped
+
+
+def _recalc_hh_history(dry_run: bool = False) -> dict:
+    """Relê Shifts em blocos, recalcula hh_total e escreve só as células K que mudaram."""
+    t0 = time.perf_counter()
+    header_rows = _get_values(f"{TAB_SHIFTS}!A1:Z1", cache=False)
+    headers = header_rows[0] if header_rows else []
+
+    c = _schema(TAB_SHIFTS, headers, SHIFT_COLUMNS)
+    cols = {
+        "start": c["start_time"],
+        "end": c["end_time"],
+        "workers": c["workers_start"],
+        "hh": c["hh_total"],
+        "break": c["break_min"],
+    }
+    last_col = _col_letter(max(13, *(i for i in cols.values() if i is not None)))
+    hh_col = _col_letter(cols["hh"])
+
+    processed = skipped = changed_total = written = 0
+    pending = []
+
+    def flush(batch):
+        nonlocal written
+        if batch and not dry_run:
+            _batch_update_values([
+                {"range": f"{TAB_SHIFTS}!{hh_col}{row}", "values": [[hh]]} for row, hh in batch
+            ])
+            written += len(batch)
+
+    start_row = 2
+    while True:
+        end_row = start_row + HH_CHUNK_ROWS - 1
+        data = _get_values(f"{TAB_SHIFTS}!A{start_row}:{last_col}{end_row}", cache=False)
+        if not data:
+            break
+
+        changed, chunk_skipped = _recalc_hh_chunk(data, start_row, cols)
+        processed += len(data)
+        skipped += chunk_skipped
+        changed_total += len(changed)
+
+        pending.extend(changed)
+        while len(pending) >= HH_BATCH_CELLS:
+            flush(pending[:HH_BATCH_CELLS])
+            pending = pending[HH_BATCH_CELLS:]
+
+        # Só um bloco vazio marca o fim: o Sheets corta linhas vazias no fim de cada bloco
+        start_row = end_row + 1
+
+    flush(pending)
+
+    elapsed = time.perf_counter() - t0
+    return {
+        "processed": processed,
+        "skipped": skipped,
+        "changed": changed_total,
+        "written": written,
+        "elapsed_s": round(elapsed, 2),
+        "rows_per_s": int(processed / elapsed) if elapsed > 0 else processed,
+    }
 
 
 # ============ Telegram UI ============
-def _teams_keyboard():
-    return InlineKeyboardMarkup([[InlineKeyboardButton(t, callback_data=f"TEAM::{t}")] for t in TEAMS])
+def _teams_keyboard(teams: list):
+    # Índice e não o nome: nomes vindos do sheet podem passar os 64 bytes de callback_data
+    return InlineKeyboardMarkup([[InlineKeyboardButton(t, callback_data=f"TEAM::{i}")] for i, t in enumerate(teams)])
 
 
 def _fields_keyboard():
-    rows = _get_values(f"{TAB_FIELDS}!A:E")
-    if not rows or len(rows) < 2:
+    fields = _fields()
+    if not fields:
         return InlineKeyboardMarkup([[InlineKeyboardButton("⚠️ Sem campos em Fields", callback_data="NOFIELDS")]])
 
-    headers = rows[0]
-    data = rows[1:]
-
-    def idx(col, default):
-        return headers.index(col) if col in headers else default
-
-    i_id = idx("field_id", 0)
-    i_name = idx("field_name", 1)
-
-    buttons = []
-    for r in data:
-        if len(r) <= max(i_id, i_name):
-            continue
-        field_id = str(r[i_id]).strip()
-        field_name = str(r[i_name]).strip()
-        if field_id and field_name:
-            buttons.append([InlineKeyboardButton(field_name, callback_data=f"FIELDID::{field_id}")])
-
+    buttons = [
+        [InlineKeyboardButton(f.field_name, callback_data=f"FIELDID::{f.field_id}")]
+        for f in fields.values() if f.field_name
+    ]
     if not buttons:
         buttons = [[InlineKeyboardButton("⚠️ Sem campos válidos", callback_data="NOFIELDS")]]
 
@@ -323,6 +936,7 @@ def _main_keyboard_for_role(role: str):
 
 
 # ============ Handlers ============
+@_profiled
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     role, name = _get_user_role_and_name(update.effective_user.id)
     if not role:
@@ -337,10 +951,70 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@_profiled
 async def myid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"🆔 O teu telegram_id é: {update.effective_user.id}")
 
 
+# Sem @_profiled: corre com block=False e ocuparia o perfil durante todo o job
+async def recalc_hh_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    role, _ = _get_user_role_and_name(update.effective_user.id)
+    if role != "admin":
+        await update.message.reply_text("⛔ Apenas admin.")
+        return
+
+    dry_run = bool(context.args) and context.args[0].lower() in ("dry", "teste")
+    await update.message.reply_text("⏳ A recalcular HH do histórico" + (" (simulação)..." if dry_run else "..."))
+
+    # Registado com block=False: o job corre à parte e o bot continua a responder aos outros
+    try:
+        stats = await asyncio.to_thread(_recalc_hh_history, dry_run)
+    except Exception as e:
+        print(f"recalc_hh falhou: {e!r}")
+        await update.message.reply_text(f"❌ Recálculo HH falhou: {e}")
+        return
+
+    print(f"recalc_hh: {stats}")
+    await update.message.reply_text(
+        f"✅ Recálculo HH {'(simulação) ' if dry_run else ''}concluído.\n"
+        f"Linhas: {stats['processed']} | Ignoradas: {stats['skipped']}\n"
+        f"Diferentes: {stats['changed']} | Escritas: {stats['written']}\n"
+        f"⏱️ {stats['elapsed_s']} s ({stats['rows_per_s']} linhas/s)"
+    )
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    role, _ = _get_user_role_and_name(update.effective_user.id)
+    if role != "admin":
+        await update.message.reply_text("⛔ Apenas admin.")
+        return
+
+    parsed = _parse_profile_args(context.args)
+    if parsed is None:
+        await update.message.reply_text(
+            "Uso: /profile N [handler] | /profile off\n"
+            f"Handlers: {', '.join(sorted(_PROFILED_HANDLERS))}"
+        )
+        return
+
+    count, handler = parsed
+    _arm_profile(update.effective_chat.id, count, handler)
+
+    # Multi-processo: o perfil é por processo, os outros workers recebem a ordem de (des)armar
+    for i, q in enumerate(context.bot_data.get("shard_queues") or []):
+        if i != context.bot_data["shard"]:
+            q.put(("profile", update.effective_chat.id, count, handler))
+
+    if not count:
+        await update.message.reply_text("⏹️ Perfil desligado.")
+        return
+    await update.message.reply_text(
+        f"⏺️ A perfilar as próximas {count} updates de {handler or 'todos os handlers'}.\n"
+        "O resumo chega aqui quando terminar."
+    )
+
+
+@_profiled
 async def today_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -357,19 +1031,19 @@ async def today_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     lines = [f"📅 Hoje ({_today_str()}):"]
     for s in shifts[:30]:
-        st = (s["status"] or "").upper()
-        line = f"• {s['team']} — {s['field']} — {st} — {s['start']}"
-        if s["end"]:
-            line += f"→{s['end']}"
-        if s["workers"]:
-            line += f" — 👥 {s['workers']}"
-        if s["hh"]:
-            line += f" — ⏱️ HH {s['hh']}"
+        line = f"• {s.team} — {s.field} — {s.status} — {s.start_time}"
+        if s.end_time:
+            line += f"→{s.end_time}"
+        if s.workers is not None:
+            line += f" — 👥 {s.workers}"
+        if s.hh is not None:
+            line += f" — ⏱️ HH {s.hh}"
         lines.append(line)
 
     await query.edit_message_text("\n".join(lines), reply_markup=_main_keyboard_for_role(role))
 
 
+@_profiled
 async def status_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -381,8 +1055,8 @@ async def status_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if role in ("admin", "viewer"):
         shifts = _list_shifts_today()
-        open_count = sum(1 for s in shifts if (s["status"] or "").upper() == "OPEN")
-        closed_count = sum(1 for s in shifts if (s["status"] or "").upper() == "CLOSED")
+        open_count = sum(1 for s in shifts if s.status == "OPEN")
+        closed_count = sum(1 for s in shifts if s.status == "CLOSED")
         await query.edit_message_text(
             f"📋 Estado hoje ({_today_str()}):\n🟢 OPEN: {open_count}\n🔴 CLOSED: {closed_count}",
             reply_markup=_main_keyboard_for_role(role)
@@ -395,11 +1069,12 @@ async def status_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("📋 Hoje: sem turno OPEN teu.", reply_markup=_main_keyboard_for_role(role))
         return
     await query.edit_message_text(
-        f"📋 Turno OPEN\nShift: {open_shift['shift_id']}\nData: {_today_str()}",
+        f"📋 Turno OPEN\nShift: {open_shift.shift_id}\nData: {_today_str()}",
         reply_markup=_main_keyboard_for_role(role)
     )
 
 
+@_profiled
 async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -413,16 +1088,18 @@ async def on_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     open_shift = _find_open_shift_for_lead_today(user_id)
     if open_shift:
-        await query.edit_message_text(f"⚠️ Já tens um turno OPEN hoje.\nShift: {open_shift['shift_id']}",
+        await query.edit_message_text(f"⚠️ Já tens um turno OPEN hoje.\nShift: {open_shift.shift_id}",
                                       reply_markup=_main_keyboard_for_role(role))
         return
 
     context.user_data.clear()
     context.user_data["flow_state"] = STATE_PICK_TEAM
     context.user_data["admin_override"] = False
-    await query.edit_message_text("Escolhe a equipa:", reply_markup=_teams_keyboard())
+    context.user_data["teams"] = _teams()
+    await query.edit_message_text("Escolhe a equipa:", reply_markup=_teams_keyboard(context.user_data["teams"]))
 
 
+@_profiled
 async def on_admin_override(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -435,16 +1112,19 @@ async def on_admin_override(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     open_shift = _find_open_shift_for_lead_today(user_id)
     if open_shift:
-        await query.edit_message_text(f"⚠️ Já tens um turno OPEN hoje.\nShift: {open_shift['shift_id']}",
+        await query.edit_message_text(f"⚠️ Já tens um turno OPEN hoje.\nShift: {open_shift.shift_id}",
                                       reply_markup=_main_keyboard_for_role(role))
         return
 
     context.user_data.clear()
     context.user_data["flow_state"] = STATE_PICK_TEAM
     context.user_data["admin_override"] = True
-    await query.edit_message_text("⚠️ ADMIN OVERRIDE: Escolhe a equipa:", reply_markup=_teams_keyboard())
+    context.user_data["teams"] = _teams()
+    await query.edit_message_text("⚠️ ADMIN OVERRIDE: Escolhe a equipa:",
+                                  reply_markup=_teams_keyboard(context.user_data["teams"]))
 
 
+@_profiled
 async def off_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -469,6 +1149,7 @@ async def off_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@_profiled
 async def off_admin_override(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -484,26 +1165,13 @@ async def off_admin_override(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.edit_message_text("⚠️ Não tens turno OPEN hoje.", reply_markup=_main_keyboard_for_role(role))
         return
 
-    headers = open_shift["headers"]
-    row = open_shift["row"]
-
-    def idx(col, default):
-        return headers.index(col) if col in headers else default
-
-    idx_start = idx("start_time", 6)      # G
-    idx_workers = idx("workers_start", 8) # I
-
-    start_time = row[idx_start] if len(row) > idx_start else ""
-    workers_raw = row[idx_workers] if len(row) > idx_workers else "0"
-    try:
-        workers = int(str(workers_raw).strip())
-    except:
-        workers = 0
+    start_time = open_shift.start_time
+    workers = open_shift.workers or 0
 
     end_time = _time_str()
-    hh_total = _calc_hh_total(start_time, end_time, workers) if workers > 0 else ""
+    hh_total = _calc_hh_total(start_time, end_time, workers, _shift_break(open_shift)) if workers > 0 else ""
 
-    sheet_row = open_shift["sheet_row"]
+    sheet_row = open_shift.sheet_row
     _update_values(f"{TAB_SHIFTS}!H{sheet_row}:H{sheet_row}", [[end_time]])       # end_time H
     _update_values(f"{TAB_SHIFTS}!J{sheet_row}:J{sheet_row}", [["CLOSED"]])      # status J
     if hh_total != "":
@@ -516,6 +1184,7 @@ async def off_admin_override(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
 
 
+@_profiled
 async def pick_team_or_field(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -524,8 +1193,13 @@ async def pick_team_or_field(update: Update, context: ContextTypes.DEFAULT_TYPE)
     data = query.data
 
     if data.startswith("TEAM::") and state == STATE_PICK_TEAM:
-        team = data.split("TEAM::", 1)[1]
-        context.user_data["team"] = team
+        # Índice na lista de equipas mostrada neste fluxo (guardada em user_data)
+        teams = context.user_data.get("teams") or []
+        i = data.split("TEAM::", 1)[1]
+        if not i.isdigit() or int(i) >= len(teams):
+            await query.edit_message_text("⚠️ Equipa inválida. Recomeça com /start.")
+            return
+        context.user_data["team"] = teams[int(i)]
         context.user_data["flow_state"] = STATE_PICK_FIELD
         await query.edit_message_text("Escolhe o campo:", reply_markup=_fields_keyboard())
         return
@@ -538,7 +1212,7 @@ async def pick_team_or_field(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return
 
         context.user_data["field_id"] = field_id
-        context.user_data["field_name"] = field["field_name"]
+        context.user_data["field_name"] = field.field_name
         context.user_data["flow_state"] = STATE_WAIT_WORKERS
         await query.edit_message_text("Quantos trabalhadores iniciam o turno? (envia só o número, ex: 12)")
         return
@@ -546,6 +1220,7 @@ async def pick_team_or_field(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.edit_message_text("⚠️ Ação inválida. Recomeça com /start.")
 
 
+@_profiled
 async def workers_count_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get("flow_state") != STATE_WAIT_WORKERS:
         return
@@ -597,6 +1272,7 @@ async def workers_count_message(update: Update, context: ContextTypes.DEFAULT_TY
     )
 
 
+@_profiled
 async def location_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.location:
         return
@@ -630,7 +1306,7 @@ async def location_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         if not ok:
             await update.message.reply_text(
-                f"🚫 Fora do perímetro.\nDistância: {dist} m | Raio: {int(field['radius_m'])} m\n"
+                f"🚫 Fora do perímetro.\nDistância: {dist} m | Raio: {int(field.radius_m)} m\n"
                 "Aproxima-te e envia novamente a localização."
             )
             return
@@ -666,18 +1342,7 @@ async def location_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data.clear()
             return
 
-        headers = open_shift["headers"]
-        row = open_shift["row"]
-
-        def idx(col, default):
-            return headers.index(col) if col in headers else default
-
-        idx_field_id = idx("field_id", 4)      # E
-        idx_start = idx("start_time", 6)       # G
-        idx_workers = idx("workers_start", 8)  # I
-
-        field_id = row[idx_field_id] if len(row) > idx_field_id else ""
-        field = _get_field_by_id(field_id)
+        field = _get_field_by_id(open_shift.field_id)
         if not field:
             await update.message.reply_text("⚠️ Campo deste turno não existe em Fields.")
             context.user_data.clear()
@@ -690,22 +1355,18 @@ async def location_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         if not ok:
             await update.message.reply_text(
-                f"🚫 Fora do perímetro.\nDistância: {dist} m | Raio: {int(field['radius_m'])} m\n"
+                f"🚫 Fora do perímetro.\nDistância: {dist} m | Raio: {int(field.radius_m)} m\n"
                 "Aproxima-te e envia novamente a localização."
             )
             return
 
-        start_time = row[idx_start] if len(row) > idx_start else ""
-        workers_raw = row[idx_workers] if len(row) > idx_workers else "0"
-        try:
-            workers = int(str(workers_raw).strip())
-        except:
-            workers = 0
+        start_time = open_shift.start_time
+        workers = open_shift.workers or 0
 
         end_time = _time_str()
-        hh_total = _calc_hh_total(start_time, end_time, workers) if workers > 0 else ""
+        hh_total = _calc_hh_total(start_time, end_time, workers, _shift_break(open_shift)) if workers > 0 else ""
 
-        sheet_row = open_shift["sheet_row"]
+        sheet_row = open_shift.sheet_row
         _update_values(f"{TAB_SHIFTS}!H{sheet_row}:H{sheet_row}", [[end_time]])      # H end_time
         _update_values(f"{TAB_SHIFTS}!J{sheet_row}:J{sheet_row}", [["CLOSED"]])     # J status
         if hh_total != "":
@@ -720,18 +1381,79 @@ async def location_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
 
-def main():
-    if not BOT_TOKEN:
-        raise RuntimeError("BOT_TOKEN não definido")
-    if not SHEET_ID:
-        raise RuntimeError("SHEET_ID/sheet_id não definido")
-    if not GOOGLE_SA_JSON:
-        raise RuntimeError("GOOGLE_SA_JSON/google_sa_json não definido")
+async def _on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    err = context.error
+    msg = update.effective_message if isinstance(update, Update) else None
+    if isinstance(err, FarmQuotaExceeded):
+        print(f"⏳ {err}")
+        if msg:
+            await msg.reply_text(f"⏳ Muitos pedidos ao Sheets neste momento. Tenta daqui a {math.ceil(err.retry_s)} s.")
+        return
+    traceback.print_exception(err)
+
+
+# ============ Workers (multi-processo) ============
+def _shard_for(update: Update, workers: int) -> int:
+    # O mesmo utilizador cai sempre no mesmo worker: as updates dele ficam em ordem
+    user = update.effective_user
+    return user.id % workers if user else 0
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+
+async def _dispatch_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # O dispatcher não lê do Sheets: só escolhe o worker (o /profile é difundido pelo worker do admin)
+    queues = context.bot_data["shard_queues"]
+    shard = _shard_for(update, len(queues))
+    _ensure_worker(context.bot_data, shard)
+    queues[shard].put(update.to_json())
+
+
+def _ensure_worker(bot_data: dict, shard: int):
+    # Um worker morto deixava as updates do seu grupo de utilizadores a acumular na fila
+    proc = bot_data["shard_procs"][shard]
+    if proc.is_alive():
+        return
+    print(f"⚠️ Worker {shard} terminou (exitcode {proc.exitcode}); a reiniciar...")
+    bot_data["shard_procs"][shard] = bot_data["start_worker"](shard)
+
+
+async def _worker_loop(shard: int, queues: list):
+    app = _build_application(with_updater=False)
+    app.bot_data["shard"] = shard
+    app.bot_data["shard_queues"] = queues
+    queue = queues[shard]
+    loop = asyncio.get_running_loop()
+    async with app:
+        # start() para que handlers com block=False (ex: /recalc_hh) corram como tasks da app
+        await app.start()
+        print(f"🔧 Worker {shard} pronto (pid {os.getpid()})")
+        while True:
+            payload = await loop.run_in_executor(None, queue.get)
+            if payload is None:
+                break
+            if isinstance(payload, tuple):
+                _, chat_id, count, handler = payload
+                _arm_profile(chat_id, count, handler)
+                continue
+            update = Update.de_json(json.loads(payload), app.bot)
+            await app.process_update(update)
+        await app.stop()
+
+
+def _worker_main(shard: int, queues: list, versions):
+    _set_broker(LocalBroker(versions))
+    try:
+        asyncio.run(_worker_loop(shard, queues))
+    except KeyboardInterrupt:
+        pass
+
+
+def _register_handlers(app):
+    app.add_handler(TypeHandler(Update, _bind_farm), group=-1)
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("id", myid))
+    app.add_handler(CommandHandler("recalc_hh", recalc_hh_command, block=False))
+    app.add_handler(CommandHandler("profile", profile_command))
 
     app.add_handler(CallbackQueryHandler(today_button, pattern="^TODAY$"))
     app.add_handler(CallbackQueryHandler(status_button, pattern="^STATUS$"))
@@ -747,8 +1469,78 @@ def main():
     app.add_handler(MessageHandler(filters.LOCATION, location_message))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, workers_count_message))
 
+    app.add_error_handler(_on_error)
+
+
+def _build_application(with_updater: bool = True):
+    builder = ApplicationBuilder().token(BOT_TOKEN)
+    if not with_updater:
+        builder = builder.updater(None)
+    app = builder.build()
+    _register_handlers(app)
+    return app
+
+
+def _run(app):
+    if WEBHOOK_URL:
+        # O Telegram envia o secret no header de cada pedido; sem ele qualquer um forjava updates
+        app.run_webhook(listen="0.0.0.0", port=PORT, webhook_url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+    else:
+        app.run_polling()
+
+
+def _run_sharded(workers: int):
+    ctx = mp.get_context("spawn")
+    manager = ctx.Manager()
+    # Partilhadas só as versões das abas; cada processo tem a sua cache de valores
+    versions = manager.dict()
+
+    queues = [ctx.Queue() for _ in range(workers)]
+
+    def start_worker(shard: int):
+        # A fila sobrevive ao processo: um worker reiniciado continua as updates pendentes
+        proc = ctx.Process(target=_worker_main, args=(shard, queues, versions),
+                           name=f"worker-{shard}", daemon=True)
+        proc.start()
+        return proc
+
+    procs = [start_worker(shard) for shard in range(workers)]
+
+    # O dispatcher só recebe updates (polling ou webhook) e distribui por utilizador
+    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app.bot_data["shard_queues"] = queues
+    app.bot_data["shard_procs"] = procs
+    app.bot_data["start_worker"] = start_worker
+    app.add_handler(TypeHandler(Update, _dispatch_update))
+
+    print(f"🤖 Dispatcher iniciado com {workers} workers...")
+    try:
+        _run(app)
+    finally:
+        for q in queues:
+            q.put(None)
+        for p in procs:
+            p.join(timeout=10)
+        manager.shutdown()
+
+
+def main():
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN não definido")
+    if not FARMS:
+        raise RuntimeError("SHEET_ID/sheet_id ou FARMS não definido")
+    if not GOOGLE_SA_JSON:
+        raise RuntimeError("GOOGLE_SA_JSON/google_sa_json não definido")
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET/webhook_secret não definido (obrigatório com WEBHOOK_URL)")
+
+    if WORKERS > 1:
+        _run_sharded(WORKERS)
+        return
+
+    app = _build_application()
     print("🤖 Bot iniciado com polling (GPS obrigatório + admin override)...")
-    app.run_polling()
+    _run(app)
 
 
 if __name__ == "__main__":